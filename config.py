@@ -27,10 +27,21 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
     # Engine options for PostgreSQL
+    # Sizing note: every gunicorn worker thread, the ADB worker (runs inside
+    # its own app_context) and each open SSE stream can hold a connection at
+    # the same time, so the default pool_size=5 queues under modest load.
     SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 20,
+        'max_overflow': 10,
         'pool_pre_ping': True,
-        'pool_recycle': 300,
+        'pool_recycle': 1800,
+        'pool_timeout': 10,
     }
+    if DATABASE_URL:
+        # psycopg 3 auto-prepares a statement after it has run this many
+        # times, skipping the parse/plan round-trip to Supabase on repeat
+        # queries (sqlite dev fallback doesn't know the argument)
+        SQLALCHEMY_ENGINE_OPTIONS['connect_args'] = {'prepare_threshold': 5}
     
     # ADB Configuration for MuMu Player
     ADB_PATH = os.environ.get('ADB_PATH') or r'F:\Program Files\Netease\MuMuPlayer\nx_main\adb.exe'
@@ -1,51 +1,125 @@
-import sqlite3
-
-def migrate():
-    conn = sqlite3.connect('instance/database.db')
-    cursor = conn.cursor()
-    
-    try:
-        # Check if columns in 'order' table need to be nullable
-        # SQLite doesn't support ALTER COLUMN, but nullable columns work automatically
-        # Just ensure the table structure is correct
-        
-        # Check current order table columns
-        cursor.execute("PRAGMA table_info('order')")
-        columns = {info[1]: info for info in cursor.fetchall()}
-        
-        print("Current 'order' table columns:")
-        for name, info in columns.items():
-            print(f"  - {name}: notnull={info[3]}")
-        
-        # For SQLite, we can't change nullable status directly
-        # But we can set default values for existing rows if needed
-        
-        # Update any NULL values that might cause issues
-        if 'link_method' in columns:
-            print("\nSetting default values for any NULL link_method entries...")
-            # Don't change existing NULLs - just report status
-            cursor.execute("SELECT COUNT(*) FROM 'order' WHERE link_method IS NULL")
-            null_count = cursor.fetchone()[0]
-            print(f"  Orders with NULL link_method: {null_count}")
-        
-        # Check user balance column
-        cursor.execute("PRAGMA table_info(user)")
-        user_columns = [info[1] for info in cursor.fetchall()]
-        
-        if 'balance' not in user_columns:
-            print("\nAdding 'balance' column to 'user' table...")
-            cursor.execute("ALTER TABLE user ADD COLUMN balance FLOAT DEFAULT 0.0")
-            conn.commit()
-            print("Migration successful: Added 'balance' column.")
-        else:
-            print("\n'balance' column already exists in user table.")
-            
-        print("\n✅ Migration check complete!")
-            
-    except Exception as e:
-        print(f"Migration failed: {e}")
-    finally:
-        conn.close()
-
-if __name__ == '__main__':
-    migrate()
+import os
+import sqlite3
+
+
+def migrate_stock_fk_cascade():
+    """Recreate the product_stock.product_id FK with ON DELETE CASCADE.
+
+    The model declares the cascade now, but databases created before that
+    still carry the plain FK, which makes product deletes fail once the
+    ORM stops deleting child rows itself (passive_deletes).
+    """
+    if os.environ.get('DATABASE_URL'):
+        from sqlalchemy import create_engine, text
+        from config import Config
+        engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
+        with engine.begin() as conn:
+            deltype = conn.execute(text(
+                "SELECT confdeltype FROM pg_constraint "
+                "WHERE conname = 'product_stock_product_id_fkey'"
+            )).scalar()
+            if deltype == 'c':
+                print("product_stock FK already cascades.")
+                return
+            conn.execute(text(
+                "ALTER TABLE product_stock "
+                "DROP CONSTRAINT IF EXISTS product_stock_product_id_fkey"
+            ))
+            conn.execute(text(
+                "ALTER TABLE product_stock "
+                "ADD CONSTRAINT product_stock_product_id_fkey "
+                "FOREIGN KEY (product_id) REFERENCES product (id) "
+                "ON DELETE CASCADE"
+            ))
+            print("Recreated product_stock FK with ON DELETE CASCADE.")
+        return
+
+    # SQLite can't alter constraints; rebuild the table with the new FK
+    conn = sqlite3.connect('instance/database.db')
+    cursor = conn.cursor()
+    try:
+        row = cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name='product_stock'"
+        ).fetchone()
+        if not row:
+            print("No product_stock table; nothing to migrate.")
+            return
+        if 'ON DELETE CASCADE' in row[0]:
+            print("product_stock FK already cascades.")
+            return
+        cursor.execute("PRAGMA foreign_keys=OFF")
+        cursor.executescript("""
+            BEGIN;
+            CREATE TABLE product_stock_new (
+                id INTEGER NOT NULL PRIMARY KEY,
+                product_id INTEGER NOT NULL REFERENCES product (id) ON DELETE CASCADE,
+                xml_file VARCHAR(500) NOT NULL,
+                is_sold BOOLEAN,
+                order_id INTEGER REFERENCES "order" (id),
+                created_at DATETIME
+            );
+            INSERT INTO product_stock_new
+                SELECT id, product_id, xml_file, is_sold, order_id, created_at
+                FROM product_stock;
+            DROP TABLE product_stock;
+            ALTER TABLE product_stock_new RENAME TO product_stock;
+            CREATE INDEX ix_stock_product_unsold ON product_stock (product_id, is_sold);
+            COMMIT;
+        """)
+        print("Rebuilt product_stock with ON DELETE CASCADE.")
+    except Exception as e:
+        print(f"FK migration failed: {e}")
+    finally:
+        conn.close()
+
+
+def migrate():
+    conn = sqlite3.connect('instance/database.db')
+    cursor = conn.cursor()
+    
+    try:
+        # Check if columns in 'order' table need to be nullable
+        # SQLite doesn't support ALTER COLUMN, but nullable columns work automatically
+        # Just ensure the table structure is correct
+        
+        # Check current order table columns
+        cursor.execute("PRAGMA table_info('order')")
+        columns = {info[1]: info for info in cursor.fetchall()}
+        
+        print("Current 'order' table columns:")
+        for name, info in columns.items():
+            print(f"  - {name}: notnull={info[3]}")
+        
+        # For SQLite, we can't change nullable status directly
+        # But we can set default values for existing rows if needed
+        
+        # Update any NULL values that might cause issues
+        if 'link_method' in columns:
+            print("\nSetting default values for any NULL link_method entries...")
+            # Don't change existing NULLs - just report status
+            cursor.execute("SELECT COUNT(*) FROM 'order' WHERE link_method IS NULL")
+            null_count = cursor.fetchone()[0]
+            print(f"  Orders with NULL link_method: {null_count}")
+        
+        # Check user balance column
+        cursor.execute("PRAGMA table_info(user)")
+        user_columns = [info[1] for info in cursor.fetchall()]
+        
+        if 'balance' not in user_columns:
+            print("\nAdding 'balance' column to 'user' table...")
+            cursor.execute("ALTER TABLE user ADD COLUMN balance FLOAT DEFAULT 0.0")
+            conn.commit()
+            print("Migration successful: Added 'balance' column.")
+        else:
+            print("\n'balance' column already exists in user table.")
+            
+        print("\n✅ Migration check complete!")
+            
+    except Exception as e:
+        print(f"Migration failed: {e}")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    migrate()
+    migrate_stock_fk_cascade()
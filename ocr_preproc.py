@@ -0,0 +1,18 @@
+"""
+OCR Preprocessing Module for Line Ranger ID Store
+Image cleanup steps applied to screenshot crops before Tesseract.
+Pure stdlib on purpose: the thresholding runs through PIL's Image.point()
+with a byte table, so importing this module stays free — adb_handler pulls
+it in at startup and must not drag NumPy (or a Numba JIT warmup) along.
+"""
+import functools
+
+
+@functools.lru_cache(maxsize=8)
+def threshold_lut(threshold):
+    """256-entry lookup table for PIL's Image.point().
+
+    point() with a byte table runs entirely in PIL's C loop, so thresholding
+    a grayscale image needs no ndarray round-trip at all.
+    """
+    return bytes([0] * (threshold + 1) + [255] * (255 - threshold))